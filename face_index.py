@@ -0,0 +1,434 @@
+import os
+import json
+import uuid
+import time
+import tracemalloc
+import argparse
+import numpy as np
+from deepface import DeepFace
+try:
+    from deepface.modules.verification import find_threshold
+except ImportError:
+    # 旧版 deepface
+    from deepface.commons.distance import findThreshold as find_threshold
+
+MODEL_NAME = "VGG-Face"
+# 与 DeepFace.find 使用同一判定阈值，保证两种检索方式的通过/拒绝结果一致
+DISTANCE_THRESHOLD = find_threshold(MODEL_NAME, "cosine")
+# 索引文件格式版本，格式变化时旧索引会被判定为过期并重建
+INDEX_VERSION = 2
+IMAGE_EXTS = (".jpg", ".jpeg", ".png")
+# 分块扫描的行数：量化码逐块复制到预分配的 float32 缓冲区再计算，
+# 4096 维时缓冲区 1 MiB，可留在 CPU 缓存中，避免每块重新分配并回写内存
+SCAN_CHUNK_ROWS = 64
+
+
+def quantize(vectors, dtype):
+    if dtype == "float16":
+        return vectors.astype(np.float16), None, None
+    if dtype == "int8":
+        # 按维度的非对称 8 位标量量化：x ≈ offset + scale * code，code 取 0~255。
+        # VGG-Face 特征经 ReLU 后基本非负，对称量化会浪费一半取值范围
+        offset = vectors.min(axis=0)
+        scale = (vectors.max(axis=0) - offset) / 255.0
+        scale[scale == 0] = 1.0
+        codes = np.clip(np.rint((vectors - offset) / scale), 0, 255).astype(np.uint8)
+        return codes, scale.astype(np.float32), offset.astype(np.float32)
+    raise ValueError(f"不支持的量化类型: {dtype}")
+
+
+def normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def list_gallery(db_path):
+    files = {}
+    for entry in os.scandir(db_path):
+        if entry.is_file() and entry.name.lower().endswith(IMAGE_EXTS):
+            files[entry.path] = entry.stat().st_mtime
+    return files
+
+
+def represent(img):
+    results = DeepFace.represent(img_path=img, model_name=MODEL_NAME, enforce_detection=True)
+    return normalize(results[0]["embedding"])
+
+
+class FaceIndex:
+    def __init__(self, db_path="face_list", index_path="face_index", dtype="int8"):
+        if dtype not in ("float16", "int8"):
+            raise ValueError(f"不支持的量化类型: {dtype}")
+        self.db_path = db_path
+        self.index_path = index_path
+        self.dtype = dtype
+        self._manifest = None
+        self._vectors = None
+        self._vectors_file = None
+        self._vectors_offset = 0
+        self._codes = None
+        self._scale = None
+        self._offset = None
+
+    def _file(self, name):
+        return os.path.join(self.index_path, name)
+
+    def _read_manifest(self):
+        try:
+            with open(self._file("manifest.json"), encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _unload(self):
+        if self._vectors_file is not None:
+            self._vectors_file.close()
+        self._manifest = None
+        self._vectors = None
+        self._vectors_file = None
+        self._codes = None
+        self._scale = None
+        self._offset = None
+
+    def _load(self):
+        # 延迟加载：首次检索时才以内存映射方式打开量化码；float32 特征不做映射，
+        # 重排时按行显式读取，避免预读把整个 float32 文件带入内存
+        if self._manifest is not None:
+            return
+        manifest = self._read_manifest()
+        if manifest is None:
+            manifest = {"dtype": self.dtype, "generation": None, "files": []}
+        if not manifest["files"]:
+            self._manifest = manifest
+            return
+        generation = manifest["generation"]
+        self._codes = np.load(self._file(f"codes_{self.dtype}_{generation}.npy"), mmap_mode="r")
+        if self.dtype == "int8":
+            self._scale = np.load(self._file(f"scale_{generation}.npy"))
+            self._offset = np.load(self._file(f"offset_{generation}.npy"))
+        self._manifest = manifest
+
+    def is_stale(self):
+        manifest = self._read_manifest()
+        if (manifest is None or manifest.get("version") != INDEX_VERSION
+                or manifest.get("dtype") != self.dtype or "generation" not in manifest):
+            return True
+        indexed = {item["path"]: item["mtime"] for item in manifest["files"] + manifest.get("skipped", [])}
+        return indexed != list_gallery(self.db_path)
+
+    def sync(self):
+        if self.is_stale():
+            self.build()
+        elif self._manifest is not None:
+            # 索引可能已被其他进程（如 python face_index.py build）重建，
+            # 此时丢弃已映射的旧一代文件，下次检索时重新加载
+            manifest = self._read_manifest()
+            if manifest is None or manifest.get("generation") != self._manifest.get("generation"):
+                self._unload()
+
+    def build(self):
+        os.makedirs(self.index_path, exist_ok=True)
+        old = self._read_manifest()
+        old_vectors = None
+        old_rows = {}
+        old_skipped = {}
+        if old is not None:
+            old_skipped = {item["path"]: item["mtime"] for item in old.get("skipped", [])}
+            if old["files"]:
+                try:
+                    old_vectors = np.load(self._file(f"vectors_float32_{old['generation']}.npy"), mmap_mode="r")
+                except (OSError, KeyError, ValueError):
+                    old_vectors = None
+                # 行数与清单不一致说明特征文件不可信，放弃复用
+                if old_vectors is not None and len(old_vectors) == len(old["files"]):
+                    old_rows = {item["path"]: (item["mtime"], row) for row, item in enumerate(old["files"])}
+
+        files = []
+        skipped = []
+        vectors = []
+        for path, mtime in sorted(list_gallery(self.db_path).items()):
+            cached = old_rows.get(path)
+            if cached is not None and cached[0] == mtime:
+                vector = np.array(old_vectors[cached[1]])
+            elif old_skipped.get(path) == mtime:
+                skipped.append({"path": path, "mtime": mtime})
+                continue
+            else:
+                try:
+                    vector = represent(path)
+                except ValueError:
+                    # 照片中检测不到人脸，记录下来以免每次同步都重新检测
+                    skipped.append({"path": path, "mtime": mtime})
+                    continue
+            files.append({"path": path, "mtime": mtime})
+            vectors.append(vector)
+
+        self._unload()
+        del old_vectors
+        # 每次建立索引都写入新一代文件，最后替换 manifest.json 完成原子切换，
+        # 中途中断时旧清单仍指向完整的旧一代文件
+        generation = uuid.uuid4().hex
+        if vectors:
+            vectors = np.stack(vectors).astype(np.float32)
+            codes, scale, offset = quantize(vectors, self.dtype)
+            self._save(f"vectors_float32_{generation}.npy", vectors)
+            self._save(f"codes_{self.dtype}_{generation}.npy", codes)
+            if scale is not None:
+                self._save(f"scale_{generation}.npy", scale)
+                self._save(f"offset_{generation}.npy", offset)
+        manifest = {"version": INDEX_VERSION, "dtype": self.dtype, "model": MODEL_NAME, "generation": generation,
+                    "files": files, "skipped": skipped}
+        tmp = self._file("manifest.json.tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self._file("manifest.json"))
+        self._remove_old_generations(generation)
+
+    def _save(self, name, array):
+        with open(self._file(name), "wb") as f:
+            np.save(f, array)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _remove_old_generations(self, generation):
+        for entry in os.scandir(self.index_path):
+            if entry.name.endswith(".npy") and not entry.name.endswith(f"_{generation}.npy"):
+                try:
+                    os.remove(entry.path)
+                except OSError:
+                    # 文件可能仍被其他进程映射，留待下次清理
+                    pass
+
+    def _vectors_path(self):
+        return self._file(f"vectors_float32_{self._manifest['generation']}.npy")
+
+    def _vector_map(self):
+        # 仅全精度扫描使用
+        if self._vectors is None:
+            self._vectors = np.load(self._vectors_path(), mmap_mode="r")
+        return self._vectors
+
+    def read_vectors(self, rows):
+        self._load()
+        dim = self._codes.shape[1]
+        if self._vectors_file is None:
+            self._vectors_file = open(self._vectors_path(), "rb", buffering=0)
+            if hasattr(os, "posix_fadvise"):
+                os.posix_fadvise(self._vectors_file.fileno(), 0, 0, os.POSIX_FADV_RANDOM)
+            version = np.lib.format.read_magic(self._vectors_file)
+            if version == (1, 0):
+                np.lib.format.read_array_header_1_0(self._vectors_file)
+            else:
+                np.lib.format.read_array_header_2_0(self._vectors_file)
+            self._vectors_offset = self._vectors_file.tell()
+        vectors = np.empty((len(rows), dim), dtype=np.float32)
+        for i, row in enumerate(rows):
+            self._vectors_file.seek(self._vectors_offset + int(row) * dim * 4)
+            self._vectors_file.readinto(vectors[i])
+        return vectors
+
+    def __len__(self):
+        self._load()
+        return len(self._manifest["files"])
+
+    @property
+    def dim(self):
+        self._load()
+        return self._codes.shape[1] if self._codes is not None else 0
+
+    @property
+    def float_bytes(self):
+        return len(self) * self.dim * 4
+
+    @property
+    def quantized_bytes(self):
+        self._load()
+        if self._codes is None:
+            return 0
+        size = self._codes.nbytes
+        if self._scale is not None:
+            size += self._scale.nbytes + self._offset.nbytes
+        return size
+
+    def coarse_scores(self, query):
+        self._load()
+        query = np.asarray(query, dtype=np.float32)
+        bias = 0.0
+        if self._scale is not None:
+            # q·x ≈ q·offset + (q * scale)·code，偏移项对所有行相同，只需计算一次
+            bias = float(query @ self._offset)
+            query = query * self._scale
+        scores = np.empty(len(self._codes), dtype=np.float32)
+        buffer = np.empty((SCAN_CHUNK_ROWS, self._codes.shape[1]), dtype=np.float32)
+        for start in range(0, len(self._codes), SCAN_CHUNK_ROWS):
+            chunk = self._codes[start:start + SCAN_CHUNK_ROWS]
+            block = buffer[:len(chunk)]
+            block[...] = chunk
+            np.dot(block, query, out=scores[start:start + len(chunk)])
+        return scores + bias
+
+    def search(self, query, top_k=1, candidates=32):
+        self._load()
+        if not self._manifest["files"]:
+            return []
+        query = normalize(query)
+        # 第一阶段：在量化向量上粗排，取出候选
+        scores = self.coarse_scores(query)
+        candidates = min(max(candidates, top_k), len(scores))
+        rows = np.argpartition(-scores, candidates - 1)[:candidates]
+        rows.sort()
+        # 第二阶段：只读取候选行的 float32 向量做精确重排
+        distances = 1.0 - self.read_vectors(rows) @ query
+        order = np.argsort(distances)[:top_k]
+        return [(self._manifest["files"][rows[i]]["path"], float(distances[i])) for i in order]
+
+    def exact_search(self, query, top_k=1):
+        self._load()
+        if not self._manifest["files"]:
+            return []
+        query = normalize(query)
+        vectors = self._vector_map()
+        distances = np.empty(len(vectors), dtype=np.float32)
+        for start in range(0, len(vectors), SCAN_CHUNK_ROWS):
+            chunk = vectors[start:start + SCAN_CHUNK_ROWS]
+            distances[start:start + len(chunk)] = 1.0 - chunk @ query
+        order = np.argsort(distances)[:top_k]
+        return [(self._manifest["files"][i]["path"], float(distances[i])) for i in order]
+
+    def find(self, img, candidates=32):
+        return accept(self.search(represent(img), top_k=1, candidates=candidates))
+
+
+def accept(results):
+    # 与 DeepFace.find 相同：最近邻距离不超过阈值才判定为匹配
+    if results and results[0][1] <= DISTANCE_THRESHOLD:
+        return results[0]
+    return None
+
+
+def resident_bytes():
+    # 进程常驻内存（含已换入的内存映射页），仅 Linux 可用
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def positive_int(value):
+    number = int(value)
+    if number <= 0:
+        raise argparse.ArgumentTypeError(f"必须为正整数: {value}")
+    return number
+
+
+def measure(search, query_vectors):
+    # 第一遍在新打开的映射上统计常驻内存增量与临时分配峰值，第二遍在页已换入后计时
+    rss_before = resident_bytes()
+    tracemalloc.start()
+    for query in query_vectors:
+        search(query)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    rss_after = resident_bytes()
+    rss = rss_after - rss_before if rss_before is not None and rss_after is not None else None
+
+    results = []
+    start = time.perf_counter()
+    for query in query_vectors:
+        results.append(search(query))
+    elapsed_ms = (time.perf_counter() - start) * 1000 / len(query_vectors)
+    return results, elapsed_ms, rss, peak
+
+
+def format_bytes(size):
+    if size is None:
+        return "不可用"
+    return f"{size / 1024 / 1024:.1f} MiB"
+
+
+def load_queries(query_path):
+    query_vectors = []
+    for path in sorted(list_gallery(query_path)):
+        try:
+            query_vectors.append(represent(path))
+        except ValueError:
+            continue
+    return np.array(query_vectors, dtype=np.float32)
+
+
+def report(index, queries=200, noise=0.3, candidates=32, seed=0, query_path=None):
+    if len(index) == 0:
+        print("人脸库为空，无法生成报告")
+        return
+
+    dim = index.dim
+    float_bytes = index.float_bytes
+    if query_path:
+        query_vectors = load_queries(query_path)
+        if len(query_vectors) == 0:
+            print(f"{query_path} 中没有可检测到人脸的查询照片")
+            return
+        source = f"查询照片 {query_path}"
+    else:
+        rng = np.random.default_rng(seed)
+        picks = rng.integers(0, len(index), size=queries)
+        # 噪声按向量范数的比例添加，模拟同一人不同照片的特征偏移
+        query_vectors = normalize(index.read_vectors(picks) + rng.normal(0, noise / np.sqrt(dim), size=(queries, dim)))
+        source = f"人脸库特征加噪声 {noise}"
+    queries = len(query_vectors)
+
+    # 每种检索各用一个新实例，使内存映射从零开始计入常驻内存
+    exact_index = FaceIndex(index.db_path, index.index_path, index.dtype)
+    two_stage_index = FaceIndex(index.db_path, index.index_path, index.dtype)
+    exact_results, exact_ms, exact_rss, exact_peak = measure(
+        lambda query: exact_index.exact_search(query), query_vectors)
+    two_stage_results, two_stage_ms, two_stage_rss, two_stage_peak = measure(
+        lambda query: two_stage_index.search(query, candidates=candidates), query_vectors)
+
+    top1_agree = sum(a[0][0] == b[0][0] for a, b in zip(exact_results, two_stage_results)) / queries
+    exact_decisions = [accept(results) for results in exact_results]
+    two_stage_decisions = [accept(results) for results in two_stage_results]
+    # 判定一致：两者都拒绝，或都通过且匹配到同一张照片
+    decision_agree = sum((a and a[0]) == (b and b[0])
+                         for a, b in zip(exact_decisions, two_stage_decisions)) / queries
+    exact_accepted = sum(a is not None for a in exact_decisions) / queries
+    two_stage_accepted = sum(b is not None for b in two_stage_decisions) / queries
+    quantized_bytes = index.quantized_bytes
+
+    print(f"人脸库规模: {len(index)} 张, 维度: {dim}, 量化类型: {index.dtype}")
+    print(f"索引文件: float32 {format_bytes(float_bytes)}, {index.dtype} {format_bytes(quantized_bytes)} "
+          f"({quantized_bytes / float_bytes:.1%})")
+    print(f"常驻内存增量: 全精度扫描 {format_bytes(exact_rss)}, 两阶段检索 {format_bytes(two_stage_rss)}")
+    print(f"临时分配峰值: 全精度扫描 {format_bytes(exact_peak)}, 两阶段检索 {format_bytes(two_stage_peak)}")
+    print(f"查询延迟: 全精度扫描 {exact_ms:.3f} ms, 两阶段检索 {two_stage_ms:.3f} ms "
+          f"(候选数 {candidates})")
+    print(f"查询来源: {source}, 共 {queries} 次查询")
+    print(f"Top-1 一致率: {top1_agree:.2%}")
+    print(f"通过/拒绝判定一致率: {decision_agree:.2%} (阈值 {DISTANCE_THRESHOLD}, "
+          f"通过率: 全精度 {exact_accepted:.2%}, 两阶段 {two_stage_accepted:.2%})")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="人脸特征量化索引")
+    parser.add_argument("command", choices=["build", "report"])
+    parser.add_argument("--db-path", default="face_list")
+    parser.add_argument("--index-path", default="face_index")
+    parser.add_argument("--dtype", choices=["float16", "int8"], default="int8")
+    parser.add_argument("--queries", type=positive_int, default=200)
+    parser.add_argument("--noise", type=float, default=0.3)
+    parser.add_argument("--candidates", type=positive_int, default=32)
+    parser.add_argument("--query-path", default=None, help="真实查询照片目录，不指定时使用人脸库特征加噪声")
+    args = parser.parse_args()
+
+    face_index = FaceIndex(args.db_path, args.index_path, args.dtype)
+    if args.command == "build":
+        face_index.build()
+        print(f"索引已建立: {len(face_index)} 张人脸")
+    else:
+        face_index.sync()
+        report(face_index, args.queries, args.noise, args.candidates, query_path=args.query_path)
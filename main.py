@@ -8,10 +8,15 @@ from PySide6.QtWidgets import (QApplication, QWidget, QMessageBox)
 from PySide6.QtSql import QSqlTableModel, QSqlDatabase
 from ui import Ui_Form
 from deepface import DeepFace
+from face_index import FaceIndex
 import matplotlib.pyplot as plt
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
 import datetime
 
+# 人脸库特征的存储方式：None 使用 DeepFace.find 全精度检索；
+# 可选 "int8" 或 "float16" 使用量化索引两阶段检索以降低内存占用（见 README）
+EMBEDDING_DTYPE = None
+
 def create_database_tables(con):
     cursor = con.cursor()
     cursor.execute('''
@@ -65,6 +70,8 @@ class MainWindow(QWidget):
             show_error_message(self, "错误", f"无法创建 face_list 目录: {e}")
             sys.exit(1)
 
+        self.face_index = FaceIndex("face_list", "face_index", EMBEDDING_DTYPE) if EMBEDDING_DTYPE else None
+
         self.con = sqlite3.connect("face_info.db")
         create_database_tables(self.con)
 
@@ -253,12 +260,20 @@ class MainWindow(QWidget):
             face_list_dir = "face_list"
 
             try:
-                results = DeepFace.find(
-                    img_path=frame, db_path=face_list_dir, model_name="VGG-Face", enforce_detection=True
-                )
+                file_path = None
+                if self.face_index is not None:
+                    self.face_index.sync()
+                    match = self.face_index.find(frame)
+                    if match is not None:
+                        file_path = match[0]
+                else:
+                    results = DeepFace.find(
+                        img_path=frame, db_path=face_list_dir, model_name="VGG-Face", enforce_detection=True
+                    )
+                    if len(results) > 0 and not results[0].empty:
+                        file_path = results[0].iloc[0]['identity']
 
-                if len(results) > 0 and not results[0].empty:
-                    file_path = results[0].iloc[0]['identity']
+                if file_path is not None:
                     file_name = os.path.basename(file_path)
                     name = file_name.split("_")[0]
                     user_id = file_name.split("_")[1].split(".")[0]